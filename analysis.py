@@ -6,7 +6,8 @@ import glob
 import json
 import os
 
-def postprocess_reaction(xtb, react_folder, metadata={}):
+def postprocess_reaction(xtb, react_folder, metadata={},
+                         structures=None, energies=None):
     """Extract chemical quantities from a reaction trajectory
 
     Parameters:
@@ -16,17 +17,24 @@ def postprocess_reaction(xtb, react_folder, metadata={}):
     react_folder (str) : folder storing the reaction data, obtained from the
     reaction_job() routine in react.py.
 
+    structures, energies (lists) : the trajectory in react_folder/opt.xyz, if
+    the caller already has it in memory. Read from the file otherwise.
+
     Returns:
     -------
     A dictionary that describes the trajectory in react_folder
 
     """
-    opt = react_folder + "/opt.xyz"
-    # Get the smiles
-    # TODO: waste of computer time reloading the same file three times...
-    smiles, E = io_utils.traj2smiles(opt,chiral=True)
-    smiles_iso, _ = io_utils.traj2smiles(opt,chiral=False)
-    structs, _ = io_utils.traj2str(opt)
+    if structures is None:
+        structs, E = io_utils.traj2str(react_folder + "/opt.xyz")
+    else:
+        structs, E = structures, energies
+
+    # Get the smiles. Bond perception is the expensive part, so each
+    # structure is only parsed once, and the isomeric SMILES are only
+    # generated for the structures that are kept.
+    pmols = io_utils.str2pybel(structs)
+    smiles = io_utils.pybel2smiles(pmols, chiral=True)
 
     mols = [smiles[0]]
     regions = []
@@ -87,19 +95,19 @@ def postprocess_reaction(xtb, react_folder, metadata={}):
                          level="vtight")
 
             # Read back
-            # TODO:again, reloading the same file twice
-            s, eprod = io_utils.traj2smiles(fn, chiral=True, index=0)
-            chiral_smiles += [s]
-            s, _ = io_utils.traj2smiles(fn, chiral=False, index=0)
-            isomeric_smiles += [s]
-            energies += [float(eprod)]
+            s, eprod = io_utils.traj2str(fn, index=0, as_list=True)
+            pmol = io_utils.str2pybel(s)
+            chiral_smiles += io_utils.pybel2smiles(pmol, chiral=True)
+            isomeric_smiles += io_utils.pybel2smiles(pmol, chiral=False)
+            energies += [float(eprod[0])]
         else:
             fn = react_folder + "/ts_%4.4i.xyz" % sindex
             with open(fn, "w") as f:
                 f.write(structs[sindex])
 
             chiral_smiles += [smiles[sindex]]
-            isomeric_smiles += [smiles_iso[sindex]]
+            isomeric_smiles += io_utils.pybel2smiles([pmols[sindex]],
+                                                     chiral=False)
             energies +=[float(E[sindex])]
 
     out = {
@@ -101,52 +101,69 @@ def read_xtb_hessian(file):
 # =================== xyz trajectory files reading/writing routines =============================
 def traj2str(filepath, index=None, as_list=False):
     """Read an xyz file containing a trajectory."""
-    structures = []
-    energies = []
-    k = 0
     with open(filepath, 'r') as f:
-        while True:
-            first_line = f.readline()
-            # EOF -> blank line
-            if not first_line:
-                break
+        return split_traj(f.read(), index=index, as_list=as_list)
 
-            this_mol = first_line
-            natoms = int(first_line.rstrip())
-
-            comment_line = f.readline()
-            this_mol += comment_line
-            E = comment_line_energy(comment_line)
-
-            for i in range(natoms):
-                this_mol += f.readline()
+def split_traj(text, index=None, as_list=False):
+    """Split a string containing an xyz trajectory, see traj2str()."""
+    # Walk through the trajectory frame by frame. Only the requested frames
+    # are joined back into strings.
+    lines = text.splitlines(keepends=True)
 
+    structures = []
+    energies = []
+    k = 0
+    i = 0
+    while i < len(lines):
+        natoms = int(lines[i])
+        if index is None or k == index:
+            this_mol = "".join(lines[i:i + natoms + 2])
+            E = comment_line_energy(lines[i + 1])
             if index is None:
                 structures += [this_mol]
                 energies += [E]
             else:
-                if k == index:
-                    if as_list:
-                        return [this_mol], [E]
-                    else:
-                        return this_mol, E
+                if as_list:
+                    return [this_mol], [E]
+                else:
+                    return this_mol, E
 
-            k+=1
+        i += natoms + 2
+        k += 1
     return structures,energies
 
-def traj2smiles(filepath, index=None, chiral=False):
-    """Read an xyz file and convert to a list of SMILES ."""
-    # Read the trajectory
-    strs, E = traj2str(filepath, index=index, as_list=True)
-    output = []
-
+def count_frames(filepath):
+    """Count the structures in an xyz trajectory file without reading them."""
+    with open(filepath, 'r') as f:
+        first_line = f.readline()
+        if not first_line:
+            return 0
+        natoms = int(first_line)
+        nlines = 1 + sum(1 for _ in f)
+    return nlines // (natoms + 2)
+
+def str2pybel(strs):
+    """Convert a list of xyz strings to a list of pybel molecules."""
+    # put string in lowercase to fix stupid openbabel bug
+    return [pybel.readstring("xyz", s.lower()) for s in strs]
+
+def pybel2smiles(mols, chiral=False):
+    """Convert a list of pybel molecules to a list of SMILES."""
     if chiral:
         flags = {"c":1,"n":1}
     else:
         flags = {"c":1,"n":1, "i":1}
-    for s in strs:
-        # put string in lowercase to fix stupid openbabel bug
-        output+= [pybel.readstring("xyz", s.lower()).write(format="smi", opt=flags).rstrip()]
+    return [m.write(format="smi", opt=flags).rstrip() for m in mols]
+
+def str2smiles(strs, chiral=False):
+    """Convert a list of xyz strings to a list of SMILES."""
+    return pybel2smiles(str2pybel(strs), chiral=chiral)
+
+def traj2smiles(filepath, index=None, chiral=False):
+    """Read an xyz file and convert to a list of SMILES ."""
+    # Read the trajectory
+    strs, E = traj2str(filepath, index=index, as_list=True)
+    output = str2smiles(strs, chiral=chiral)
 
     if index is None:
         return output, E
@@ -185,21 +202,43 @@ def traj2npy(filepath, index=None):
     else:
         return atoms[0], positions[0], E[0]
 
+_energy_re = re.compile('-?[0-9]*\.[0-9]*')
+
 def comment_line_energy(comment_line):
-    m = re.search('-?[0-9]*\.[0-9]*', comment_line)
+    # xtb writes comment lines as " energy: <E> gnorm: <g> xtb: <version>", in
+    # which case we can skip the regex.
+    parts = comment_line.split(None, 2)
+    if len(parts) > 1 and parts[0] == "energy:":
+        try:
+            return float(parts[1])
+        except ValueError:
+            pass
+
+    m = _energy_re.search(comment_line)
     if m:
         E = float(m.group())
     else:
         E = np.nan
     return E
 
+def read_xyz(filepath):
+    """Read the first structure of an xyz file into atoms and positions."""
+    with open(filepath, 'r') as f:
+        # the atom count fixes the shape, so only those lines are read
+        natoms = int(f.readline())
+        f.readline()
+        lines = [f.readline() for i in range(natoms)]
+    atoms = [line.split(None, 1)[0] for line in lines]
+    positions = np.loadtxt(lines, usecols=(1,2,3), dtype=np.float64,
+                           ndmin=2).reshape((natoms, 3))
+    return atoms, positions
+
 def xyz2numpy(string):
     """Convert xyz file as a string to a numpy array."""
     # remove the two lines of the header and any empty lines at the end
     lines = [l for l in string.split("\n")[2:] if l]
-    atoms = []
-    positions = np.zeros((len(lines), 3))
-    for iatom, line in enumerate(lines):
-        positions[iatom,:] = np.fromstring(line[2:], count=3, sep=" ")
-        atoms += [line[0:2].rstrip().lstrip()]
+    atoms = [line[0:2].strip() for line in lines]
+    # convert all the coordinates at once
+    positions = np.array([line[2:].split()[:3] for line in lines],
+                         dtype=np.float64).reshape((len(lines), 3))
     return atoms, positions
@@ -1,12 +1,16 @@
-from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from contextlib import contextmanager
+from itertools import chain, zip_longest
+import copy
+import multiprocessing
 import react_utils
-from io_utils import traj2str, read_xtb_hessian
+from io_utils import traj2str, split_traj, count_frames, read_xtb_hessian
 import shutil
 import numpy as np
 from math import inf
 import os
-from glob import glob
-import tempfile
+import random
+import re
 from constants import hartree_ev, ev_kcalmol
 
 """
@@ -14,6 +18,39 @@ This file contains a bunch of user-friendly, multithreaded drivers for
 react_utils.
 """
 
+@contextmanager
+def worker_pool(pool=None, nthreads=1):
+    """Yield pool, or a fresh process pool with nthreads workers if None.
+
+    The drivers below take an optional executor so that a single persistent
+    pool can be shared across all the phases of a search.
+    """
+    if pool is None:
+        # Workers are spawned rather than forked, which is safer on HPC
+        # systems and avoids inheriting the state of the parent.
+        with ProcessPoolExecutor(max_workers=nthreads,
+                                 mp_context=multiprocessing.get_context("spawn"),
+                                 initializer=react_utils.init_worker) as new_pool:
+            yield new_pool
+    else:
+        yield pool
+
+def completed(futures):
+    """Yield futures as they complete, failing fast on the first exception.
+
+    When a future raises, those that have not started yet are cancelled before
+    the exception is propagated, so that a shared pool does not keep working
+    through the rest of a failed batch.
+    """
+    try:
+        for f in as_completed(futures):
+            f.result()
+            yield f
+    except BaseException:
+        for f in futures:
+            f.cancel()
+        raise
+
 
 def generate_initial_structures(xtb_driver,
                                 workdir,
@@ -23,7 +60,7 @@ def generate_initial_structures(xtb_driver,
                                 verbose=True):
 
     outputdir = workdir + "/init"
-    os.makedirs(outputdir)
+    os.makedirs(outputdir, exist_ok=True)
 
     if not parameters["imtd"]:
         if verbose:
@@ -42,6 +79,10 @@ def generate_initial_structures(xtb_driver,
         Natoms = int(f.readline())
     md = parameters["imtd_md"] + ["time=%f" % (parameters["imtd_time_per_atom"] * Natoms)]
 
+    # The driven coordinate is held at its starting value for both attempts
+    # below.
+    constraint = react_utils.make_constraint(atoms, low, parameters["force"])
+
     # run the metadynamics
     mtd_job = xtb_driver.metadyn(
         guess_xyz_file,
@@ -51,12 +92,11 @@ def generate_initial_structures(xtb_driver,
             wall=parameters["wall"],
             metadyn=parameters["imtd_metadyn"],
             md=md,
-            constrain=react_utils.make_constraint(
-                atoms, low, parameters["force"])))
+            constrain=constraint))
     mtd_job()
-    structures, E= traj2str(outputdir + "/init_mtd.xyz")
+    nstructures = count_frames(outputdir + "/init_mtd.xyz")
 
-    if len(structures) == 1:
+    if nstructures == 1:
         print("   convergence issues, restarting with tighter parameters...")
         md = parameters["imtd_md_tight"] \
             + ["time=%f" % (parameters["imtd_time_per_atom"] * Natoms)]
@@ -71,12 +111,11 @@ def generate_initial_structures(xtb_driver,
                 metadyn=parameters["imtd_metadyn"],
                 md=md,
                 cma="",
-                constrain=react_utils.make_constraint(
-                    atoms, low, parameters["force"])))
+                constrain=constraint))
         mtd_job()
-        structures, E= traj2str(outputdir + "/init_mtd.xyz")
+        nstructures = count_frames(outputdir + "/init_mtd.xyz")
 
-    print("   done! %i starting structures" % len(structures))
+    print("   done! %i starting structures" % nstructures)
 
 
 def select_initial_structures(xtb_driver,
@@ -84,6 +123,7 @@ def select_initial_structures(xtb_driver,
                               atoms, low,high,npts,
                               parameters,
                               nthreads=1,
+                              pool=None,
                               verbose=True):
 
     outputdir = workdir + "/init"
@@ -96,7 +136,7 @@ def select_initial_structures(xtb_driver,
         atoms, low, high, npts,
         structures, guess_xyz,
         parameters, verbose=verbose,
-        nthreads=nthreads)
+        nthreads=nthreads, pool=pool)
 
     # load structures
     if parameters["mtd_indices"]:
@@ -116,7 +156,7 @@ def select_initial_structures(xtb_driver,
     m = int(max(len(structures) * parameters["imtd_proportion"], 1))
     structures = [(s,E) for s,E in zip(refined,Eref)]
     structures = structures[:m]
-    np.random.shuffle(structures)
+    random.Random(parameters.get("seed")).shuffle(structures)
 
     print("\n")
     print("Metadynamics seed structures (N=%i)" % len(mtd_indices))
@@ -124,37 +164,46 @@ def select_initial_structures(xtb_driver,
     pts = np.linspace(low,high,npts)
     curr = 0
 
-    # todo: parallelize here
-    for ind in mtd_indices:
-        s1, E1 = structures[curr]
-
-        # Now stretch to the metadynamics index
-        s1file = outputdir + "/mtdi_%3.3i.xyz" % ind
-        with open(s1file, "w") as f:
-            f.write(s1)
-
-        if ind > 0:
-            news, newe = react_utils.stretch(
-                xtb_driver, s1file,
-                atoms,
-                low, pts[ind], ind+1,
-                parameters,
-                failout=outputdir + "/FAILED_%s" %s1file,
-                verbose=False)
-        else:
-            news = [s1]
-            newe = [E1]
+    # Each seed structure is stretched to its metadynamics index as an
+    # independent, single-threaded job.
+    seeds = []
+    futures = []
+    with worker_pool(pool, nthreads) as pool:
+        for ind in mtd_indices:
+            s1, E1 = structures[curr]
+            seeds += [(s1, E1)]
+
+            # Now stretch to the metadynamics index
+            if ind > 0:
+                futures += [pool.submit(
+                    react_utils.stretch,
+                    xtb_driver, None,
+                    atoms,
+                    low, pts[ind], ind+1,
+                    parameters,
+                    failout=outputdir + "/FAILED_mtdi_%3.3i" % ind,
+                    verbose=False,
+                    initial_str=s1)]
+            else:
+                futures += [None]
+
+            curr += 1
+            if curr == len(structures):
+                # loop around
+                curr = 0
 
-        print(" %3.3i |  %7.3f  |  %7.3f  |  %7.3f "
-              % (ind, newe[0], newe[-1], hartree_ev * ev_kcalmol * (newe[-1] - newe[0])))
+        for ind, (s1, E1), future in zip(mtd_indices, seeds, futures):
+            if future is None:
+                news = [s1]
+                newe = [E1]
+            else:
+                news, newe = future.result()
 
-        with open(outputdir + "/opt%4.4i.xyz" % ind, "w") as f:
-            f.write(news[-1])
+            print(" %3.3i |  %7.3f  |  %7.3f  |  %7.3f "
+                  % (ind, newe[0], newe[-1], hartree_ev * ev_kcalmol * (newe[-1] - newe[0])))
 
-        curr += 1
-        if curr == len(structures):
-            # loop around
-            curr = 0
+            with open(outputdir + "/opt%4.4i.xyz" % ind, "w") as f:
+                f.write(news[-1])
 
     if verbose:
         print("Done!")
@@ -167,7 +216,9 @@ def metadynamics_search(xtb_driver,
                         atoms, low, high, npts,
                         parameters,
                         verbose=True,
-                        nthreads=1):
+                        nthreads=1,
+                        pool=None,
+                        state=None):
 
     if verbose:
         print("-----------------------------------------------------------------")
@@ -175,28 +226,45 @@ def metadynamics_search(xtb_driver,
         print("with %i threads. Working..." % nthreads)
 
 
-    with ThreadPoolExecutor(max_workers=nthreads) as pool:
-        futures = []
-
-        for mtd_index in mtd_indices:
-            mtd_jobs = react_utils.metadynamics_jobs(
-                xtb_driver, mtd_index,
-                atoms, low, high, npts,
-                workdir +"/init", workdir + "/metadyn", parameters)
+    # The driver is copied, as the jobs are sent to the workers
+    # asynchronously.
+    mtd_driver = copy.copy(xtb_driver)
 
-            for ji,j in enumerate(mtd_jobs):
-                futures += [pool.submit(j)]
-
-                if verbose:
-                    futures[-1].add_done_callback(
-                        lambda _: print("🔨",end="",flush=True))
-
-        for f in futures:
-            f.result()
+    # Collect the jobs that remain to be done.
+    jobs = []
+    for mtd_index in mtd_indices:
+        mtd_jobs = react_utils.metadynamics_jobs(
+            mtd_driver, mtd_index,
+            atoms, low, high, npts,
+            workdir +"/init", workdir + "/metadyn", parameters)
+
+        for ji,j in enumerate(mtd_jobs):
+            key = "%i_%i" % (mtd_index, ji)
+            if state is not None and state.done("mtd", key):
+                continue
+            jobs += [(key, j)]
+
+    # When there are fewer jobs than threads, the spare threads are shared
+    # between the jobs. This is read when the jobs are submitted.
+    mtd_driver.nthreads = max(1, nthreads // max(1, len(jobs)))
+
+    with worker_pool(pool, nthreads) as pool:
+        futures = {}
+        for key, j in jobs:
+            futures[pool.submit(j)] = key
+
+        # crash as soon as any job raises an exception
+        for f in completed(futures):
+            if state is not None:
+                state.mark("mtd", futures[f])
+            if verbose:
+                print("🔨",end="",flush=True)
 
     if verbose:
         print("\nDone!\n")
 
+_mtd_file_re = re.compile(r"mtd(\d+)_.*\.xyz$")
+
 def metadynamics_refine(xtb_driver,
                         workdir,
                         reference,
@@ -204,15 +272,32 @@ def metadynamics_refine(xtb_driver,
                         atoms, low, high, npts,
                         parameters,
                         verbose=True,
-                        nthreads=1):
+                        nthreads=1,
+                        pool=None,
+                        state=None):
     refined_dir = workdir + "/CRE"
     mtd_dir = workdir + "/metadyn"
     os.makedirs(refined_dir, exist_ok=True)
 
+    # Sort the metadynamics output files by index in a single directory scan.
+    # The directory is missing when no metadynamics was run.
+    mtd_files = {}
+    try:
+        with os.scandir(mtd_dir) as it:
+            for entry in it:
+                m = _mtd_file_re.match(entry.name)
+                if m:
+                    mtd_files.setdefault(int(m.group(1)), []).append(entry.path)
+    except FileNotFoundError:
+        pass
+
     for mtd_index in mtd_indices:
+        if state is not None and state.done("refine", mtd_index):
+            continue
+
         structures = []
         Es = []
-        for file in glob(mtd_dir + "/mtd%4.4i_*.xyz"%mtd_index):
+        for file in sorted(mtd_files.get(mtd_index, [])):
             structs, E = traj2str(file)
             structures += structs
             Es += E
@@ -226,13 +311,14 @@ def metadynamics_refine(xtb_driver,
             atoms, low, high, npts,
             structures, None,
             parameters, verbose=verbose,
-            nthreads=nthreads)
+            nthreads=nthreads, pool=pool)
 
         fn = refined_dir + "/mtd%4.4i.xyz" % mtd_index
-        f = open(fn, "w")
-        for s in refined:
-            f.write(s)
-        f.close()
+        with open(fn, "w", buffering=1<<20) as f:
+            f.write("".join(refined))
+
+        if state is not None:
+            state.mark("refine", mtd_index)
 
         if verbose:
             print("  → %i structures selected for reactions 🔥" % len(refined))
@@ -241,31 +327,34 @@ def refine_structures(xtb, imtd,
                       atoms, low, high, npts,
                       structures, reference,
                       parameters,
-                      verbose=True, nthreads=1):
+                      verbose=True, nthreads=1, pool=None):
 
-    # make the constraints
+    # make the constraints, which are the same for every structure
     points = np.linspace(low,high,npts)
+    xcontrol = dict(wall=parameters["wall"],
+                    constrain = react_utils.make_constraint(
+                        atoms, points[imtd], parameters["force"]))
 
-    with ThreadPoolExecutor(max_workers=nthreads) as pool:
+    # The optimizations are short, so they are sent to the pool in batches to
+    # amortize the per-task overhead.
+    batch = parameters.get("opt_batch")
+    if not batch:
+        batch = max(1, len(structures) // (nthreads * 4))
+
+    with worker_pool(pool, nthreads) as pool:
         futures = []
-        for s in structures:
+        for i in range(0, len(structures), batch):
             future = pool.submit(
-                react_utils.quick_opt_job,
-                xtb, s, parameters["optcregen"],
-                dict(wall=parameters["wall"],
-                     constrain = react_utils.make_constraint(
-                         atoms, points[imtd], parameters["force"])
-                ))
-            futures += [future]
+                react_utils.quick_opt_batch,
+                xtb, structures[i:i+batch], parameters["optcregen"],
+                xcontrol)
+            futures.append(future)
 
         converged = []
         errors = []
-        for f in futures:
-            exc = f.exception()
-            if exc:
-                errors += [f]
-            else:
-                converged += [f.result()]
+        for f in as_completed(futures):
+            for tag, val in f.result():
+                (converged if tag == "ok" else errors).append(val)
 
         if verbose:
             print("        converged 👍: %i"% len(converged))
@@ -288,27 +377,44 @@ def refine_structures(xtb, imtd,
         structures = []
         energies = []
         for mols in [set_newstable, set_unstable]:
-            with tempfile.NamedTemporaryFile(suffix=".xyz", dir=xtb.scratchdir) as T:
-                for s,E in mols:
-                    T.write(bytes(s, 'ascii'))
-                T.flush()
+            if not mols:
+                continue
+
+            # CREGEN needs its input on disk, but the output is kept in
+            # memory.
+            T = react_utils.get_scratch_file(xtb.scratchdir)
+            try:
+                with open(T, "w", buffering=1<<20) as f:
+                    f.write("".join(s for s,E in mols))
 
                 if reference is None:
-                    ref = T.name
+                    ref = T
                 else:
                     ref = reference
 
                 # Run CREGEN on temp file
                 cre = xtb.cregen(ref,
-                                        T.name, T.name,
-                                        ewin=parameters["emax_local"],
-                                        rthr=parameters["rthr"],
-                                        ethr=parameters["ethr"],
-                                        bthr=parameters["bthr"])
+                                 T, None,
+                                 ewin=parameters["emax_local"],
+                                 rthr=parameters["rthr"],
+                                 ethr=parameters["ethr"],
+                                 bthr=parameters["bthr"])
                 error = cre()
-                s, E = traj2str(T.name)
-                structures += s
-                energies += E
+            finally:
+                react_utils.release_scratch_file(T, xtb.scratchdir)
+            if error == 0:
+                s, E = split_traj(cre.output["crest_ensemble.xyz"])
+            else:
+                # keep the structures, sorted by energy as CREGEN would,
+                # rather than losing them
+                if verbose:
+                    print("        warning: CREGEN failed, keeping all %i structures"
+                          % len(mols))
+                mols = sorted(mols, key=lambda x: x[1])
+                s = [s for s,E in mols]
+                E = [E for s,E in mols]
+            structures += s
+            energies += E
 
         out_structures = []
         out_energies = []
@@ -327,7 +433,9 @@ def react(xtb_driver,
           atoms, low, high, npts,
           parameters,
           verbose=True,
-          nthreads=1):
+          nthreads=1,
+          pool=None,
+          state=None):
     if verbose:
         print("\n")
         print("-----------------------------------------------------------------")
@@ -357,41 +465,45 @@ def react(xtb_driver,
     if verbose:
         print("building round-robin worklist...")
 
-    worklist = []
-    while True:
-        for mtd_index, ls_structs in all_structures:
-            if len(ls_structs):
-                worklist += [(mtd_index,ls_structs.pop(0))]
-            else:
-                all_structures.remove([mtd_index,ls_structs])
+    # Interleave the structures of every MTD index, dropping the padding
+    # zip_longest adds when the lists have different lengths.
+    columns = [[(mtd_index, s) for s in ls_structs]
+               for mtd_index, ls_structs in all_structures]
+    worklist = [job for job in chain.from_iterable(zip_longest(*columns))
+                if job is not None]
 
-        if len(all_structures) == 0:
-            break
-
-    np.random.shuffle(worklist)
+    random.Random(parameters.get("seed")).shuffle(worklist)
     if verbose:
         print("📜 = %i reactions to compute"% len(worklist))
         print("    with the help of 🧔 × %i threads" % nthreads)
 
     nreact = 0
-    os.makedirs(workdir + "/reactions/")
-    with ThreadPoolExecutor(max_workers=nthreads) as pool:
-        futures = []
+    os.makedirs(workdir + "/reactions/", exist_ok=True)
+    with worker_pool(pool, nthreads) as pool:
+        futures = {}
 
         for mtd_index, structure in worklist:
-            futures += [pool.submit(
+            folder = workdir + "/reactions/%5.5i/" % nreact
+            if state is not None and state.done("react", nreact):
+                nreact = nreact + 1
+                continue
+
+            # remove the output of an interrupted run of this reaction
+            shutil.rmtree(folder, ignore_errors=True)
+            futures[pool.submit(
                 react_utils.reaction_job(
                     xtb_driver,
                     structure,
                     mtd_index,
                     atoms, low, high, npts,
-                    workdir + "/reactions/%5.5i/" % nreact,
-                    parameters))]
+                    folder,
+                    parameters))] = nreact
             nreact = nreact + 1
 
-        for f in futures:
-            # crash if f raised exception
-            f.result()
+        # crash if any job raised an exception
+        for f in completed(futures):
+            if state is not None:
+                state.mark("react", futures[f])
 
     if verbose:
         print("No more work to do! 🧔🍻\n\n")
@@ -1,41 +1,135 @@
 import os
-import shutil
 import subprocess
 import numpy as np
 import tempfile
 import re
+import queue
+import multiprocessing.util
+from functools import partial
 from analysis import postprocess_reaction
-from io_utils import traj2str
+from xtb_utils import remove_run_dirs, close_log_files, make_xcontrol
+from io_utils import split_traj
+
+# ------------------- scratch file pool ----------------------------------#
+# Scratch files are reused instead of being created and deleted for every
+# call, which is slow on networked file systems. There is one pool per process
+# and scratch directory, so that worker processes never pick up the files of
+# the parent they were forked from.
+_scratch_pools = {}
+_scratch_pool_size = 4 * (os.cpu_count() or 1)
+
+def _scratch_pool(scratchdir):
+    key = (os.getpid(), scratchdir)
+    try:
+        return _scratch_pools[key]
+    except KeyError:
+        return _scratch_pools.setdefault(
+            key, queue.LifoQueue(maxsize=_scratch_pool_size))
+
+def get_scratch_file(scratchdir):
+    """Return the path to an empty .xyz scratch file in scratchdir."""
+    try:
+        path = _scratch_pool(scratchdir).get_nowait()
+    except queue.Empty:
+        fd, path = tempfile.mkstemp(suffix=".xyz", dir=scratchdir)
+        os.close(fd)
+    else:
+        # truncate whatever the last user left behind
+        open(path, "w").close()
+    return path
+
+def release_scratch_file(path, scratchdir):
+    """Return a file obtained from get_scratch_file() to the pool."""
+    try:
+        _scratch_pool(scratchdir).put_nowait(path)
+    except queue.Full:
+        os.remove(path)
+
+def drain_scratch_pool():
+    """Delete the pooled scratch files of the current process."""
+    pid = os.getpid()
+    for (owner, scratchdir), pool in list(_scratch_pools.items()):
+        if owner != pid:
+            continue
+        while True:
+            try:
+                path = pool.get_nowait()
+            except queue.Empty:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+def init_worker():
+    """Initializer for worker processes of the drivers in react.py."""
+    # Pool workers exit without running atexit handlers, but multiprocessing
+    # finalizers are still called.
+    multiprocessing.util.Finalize(None, drain_scratch_pool, exitpriority=0)
+    multiprocessing.util.Finalize(None, remove_run_dirs, exitpriority=0)
+    multiprocessing.util.Finalize(None, close_log_files, exitpriority=0)
 
 # ------------------- utility routines -----------------------------------#
 def dump_succ_opt(output_folder, structures, energies,
                   split=False):
 
     os.makedirs(output_folder, exist_ok=True)
-    # Dump the optimized structures in one file
-    with open(output_folder + "/opt.xyz", "w") as f:
-        for s in structures:
-            f.write(s)
+    # Dump the optimized structures in one file, with a single write.
+    with open(output_folder + "/opt.xyz", "w", buffering=1<<20) as f:
+        f.write("".join(structures))
 
     if split:
         # Also dump the optimized structures in many files
         for stepi, s in enumerate(structures):
-            with open(output_folder + "/opt%4.4i.xyz" % stepi, "w") as f:
+            with open(output_folder + "/opt%4.4i.xyz" % stepi, "w",
+                      buffering=1<<20) as f:
                 f.write(s)
 
-def quick_opt_job(xtb, xyz, level, xcontrol):
-    # TODO comment
-    with tempfile.NamedTemporaryFile(suffix=".xyz",
+def run_xtb_job(build, *args, **kwargs):
+    """Build an xtb job using the driver method build and run it.
+
+    xtb_run objects hold open file handles and can't be sent to worker
+    processes, so jobs are instead passed around as partial(run_xtb_job, ...)
+    and only built in the worker.
+    """
+    job = build(*args, **kwargs)
+    return job()
+
+def quick_opt_job(xtb, xyz, level, xcontrol, xcontrol_file=None):
+    """Optimize the xyz string xyz and return the optimized (xyz, E)."""
+    # The structures are passed in and out of the xtb run directory as
+    # strings, without any intermediate file.
+    opt = xtb.optimize(None,
+                       None,
+                       level=level,
+                       xcontrol=xcontrol,
+                       input_str=xyz,
+                       xcontrol_file=xcontrol_file)
+    opt()
+    out = split_traj(opt.output.get("xtbopt.xyz", ""), 0, as_list=True)
+    if not out[0]:
+        raise RuntimeError("xtb optimization produced no structure")
+    return out[0][0], out[1][0]
+
+def quick_opt_batch(xtb, structures, level, xcontrol):
+    """Run quick_opt_job() on a list of xyz strings within a single job.
+
+    Returns a list of ("ok", (xyz, E)) tuples for successful optimizations and
+    ("err", exception) tuples for those that raised.
+    """
+    out = []
+    # The xcontrol is the same for the whole batch, so it is only rendered
+    # once.
+    with tempfile.NamedTemporaryFile(suffix=".xcontrol",
                                      dir=xtb.scratchdir) as T:
-        T.write(bytes(xyz, 'ascii'))
-        T.flush()
-        opt = xtb.optimize(T.name,
-                           T.name,
-                           level=level,
-                           xcontrol=xcontrol)
-        opt()
-        xyz, E = traj2str(T.name, 0)
-    return xyz, E
+        make_xcontrol(xcontrol, T.name)
+        for xyz in structures:
+            try:
+                out += [("ok", quick_opt_job(xtb, xyz, level, xcontrol,
+                                             xcontrol_file=T.name))]
+            except Exception as e:
+                out += [("err", e)]
+    return out
 
 def make_constraint(atoms, val, force):
     if len(atoms) == 2:
@@ -54,7 +148,8 @@ def stretch(xtb, initial_xyz,
             atoms, low, high, npts,
             parameters,
             failout=None,
-            verbose=True):
+            verbose=True,
+            initial_str=None):
     """Optimize a structure through successive constraints.
 
     TODO FIX
@@ -64,7 +159,8 @@ def stretch(xtb, initial_xyz,
 
     xtb (xtb_driver) : driver object for xtb.
 
-    initial_xyz (str): path to initial structure xyz file.
+    initial_xyz (str): path to initial structure xyz file. Can be None if
+    initial_str is given.
 
     parameters (dict) : additional parameters, as obtained from
     default_parameters() above. TODO: Describe parameters in more details
@@ -77,6 +173,9 @@ def stretch(xtb, initial_xyz,
 
     verbose (bool) : print information about the run. defaults to True.
 
+    initial_str (str) : initial structure as an xyz string, used in place of
+    the initial_xyz file.
+
     Returns:
     --------
 
@@ -86,32 +185,25 @@ def stretch(xtb, initial_xyz,
     energies : list of floats of xtb energies (in Hartrees) for the structures.
 
     """
-    # Make scratch files
-    fdc, current = tempfile.mkstemp(suffix=".xyz", dir=xtb.scratchdir)
-
-    # prepare the current file
-    shutil.copyfile(initial_xyz, current)
-
-    opt = xtb.optimize(current,
-                       current,
+    # The scan trajectory is read straight from the xtb run directory.
+    opt = xtb.optimize(initial_xyz,
+                       None,
                        failout=failout,
                        level=parameters["optim"],
                        xcontrol=dict(
                            wall=parameters["wall"],
                            constrain=make_constraint(atoms,
                                                      low, parameters["force"]),
-                           scan=("1: %f, %f, %i" % (low, high, npts),)))
+                           scan=("1: %f, %f, %i" % (low, high, npts),)),
+                       input_str=initial_str)
 
     error = opt()
-    structs, energies = traj2str(current)
+    structs, energies = split_traj(opt.output.get("xtbscan.log", ""))
 
     if verbose:
         for k, E in enumerate(energies):
             print("   👣=%4i    energy💡= %9.5f Eₕ"%(k, E))
 
-    # Got to make sure that you close the filehandles!
-    os.close(fdc)
-    os.remove(current)
     return structs, energies
 
 def metadynamics_jobs(xtb,
@@ -123,8 +215,8 @@ def metadynamics_jobs(xtb,
     """Return a metadynamics search job for other "transition" conformers.
 
     mtd_index is the index of the starting structure to use as a starting
-    point in the metadynamics run. Returns an unevaluated xtb_job to be used
-    in ThreadPool.
+    point in the metadynamics run. Returns unevaluated (and picklable) xtb
+    jobs to be submitted to a worker pool.
 
     Parameters:
     -----------
@@ -164,20 +256,20 @@ def metadynamics_jobs(xtb,
 
     # stretch points
     points = np.linspace(low, high, npts)
+    constraint = make_constraint(atoms, points[mtd_index], parameters["force"])
 
     for metadyn_job, metadyn_params in enumerate(parameters["tsmtd_params"]):
         outp = output_folder + "/mtd%4.4i_%2.2i.xyz" % (mtd_index,metadyn_job)
         mjobs += [
-            xtb.metadyn(inp, outp,
-                        failout=output_folder +
-                        "/FAIL%4.4i_%2.2i.xyz" % (mtd_index, metadyn_job),
-                        xcontrol=dict(
-                            wall=parameters["wall"],
-                            metadyn=metadyn_params,
-                            md=md,
-                            constrain=make_constraint(atoms,
-                                                      points[mtd_index],
-                                                      parameters["force"])))]
+            partial(run_xtb_job, xtb.metadyn,
+                    inp, outp,
+                    failout=output_folder +
+                    "/FAIL%4.4i_%2.2i.xyz" % (mtd_index, metadyn_job),
+                    xcontrol=dict(
+                        wall=parameters["wall"],
+                        metadyn=metadyn_params,
+                        md=md,
+                        constrain=constraint))]
     return mjobs
 
 def reaction_job(xtb,
@@ -195,7 +287,7 @@ def reaction_job(xtb,
 
     This is the final step in the reaction space search, and it generates
     molecular trajectories. It should be noted that this function returns an
-    unevaluated job, to be fed to ThreadPool.
+    unevaluated (and picklable) job, to be fed to a worker pool.
 
     Parameters:
     -----------
@@ -222,70 +314,79 @@ def reaction_job(xtb,
     Returns:
     --------
 
-    react_job() : function which, when evaluated, computes the trajectory
+    react_job : function which, when evaluated, computes the trajectory
 
     """
 
-    def react_job():
-        os.makedirs(output_folder, exist_ok=True)
-
-        with open(output_folder + "/initial.xyz", "w") as f:
-            f.write(initial_xyz)
-
-        points = np.linspace(low, high, npts)
-        forw = points[mtd_index:]
-        # note: we want back to start at the same point as forward, otherwise
-        # we get a lot more stretch on the backward trajectory and weird stuff
-        # happens
-        back = points[:mtd_index+1][::-1]
-
-        # We want to make sure to optimize the initial xyz so that both
-        # forward and backward start from optimized structures.
-        opt = xtb.optimize(output_folder + "initial.xyz",
-                           output_folder + "start.xyz",
-                           failout=output_folder + "/FAILED_OPT",
-                           level=parameters["optim"],
-                           xcontrol=dict(
-                               wall=parameters["wall"],
-                               constrain=make_constraint(
-                                   atoms,
-                                   forw[0], parameters["force"])))
-        opt()
-
-
-        # Forward reaction
-        fstructs, fe = stretch(
+    return partial(react_job, xtb, initial_xyz, mtd_index,
+                   atoms, low, high, npts,
+                   output_folder, parameters)
+
+def react_job(xtb,
+              initial_xyz,
+              mtd_index,
+              atoms, low, high, npts,
+              output_folder,
+              parameters):
+    """Compute the reaction trajectory described in reaction_job()."""
+    os.makedirs(output_folder, exist_ok=True)
+
+    points = np.linspace(low, high, npts)
+    forw = points[mtd_index:]
+    # note: we want back to start at the same point as forward, otherwise
+    # we get a lot more stretch on the backward trajectory and weird stuff
+    # happens
+    back = points[:mtd_index+1][::-1]
+
+    # We want to make sure to optimize the initial xyz so that both
+    # forward and backward start from optimized structures.
+    opt = xtb.optimize(None,
+                       output_folder + "start.xyz",
+                       failout=output_folder + "/FAILED_OPT",
+                       level=parameters["optim"],
+                       xcontrol=dict(
+                           wall=parameters["wall"],
+                           constrain=make_constraint(
+                               atoms,
+                               forw[0], parameters["force"])),
+                       input_str=initial_xyz)
+    opt()
+
+
+    # Forward reaction
+    fstructs, fe = stretch(
+        xtb, output_folder + "/start.xyz",
+        atoms, forw[0], forw[-1], len(forw),
+        parameters,
+        failout=output_folder + "/FAILED_FORWARD",
+        verbose=False)          # otherwise its way too verbose
+
+    # Backward reaction
+    if len(back)>1:
+        bstructs, be = stretch(
             xtb, output_folder + "/start.xyz",
-            atoms, forw[0], forw[-1], len(forw),
+            atoms, back[0], back[-1], len(back),
             parameters,
-            failout=output_folder + "/FAILED_FORWARD",
+            failout=output_folder + "/FAILED_BACKWARD",
             verbose=False)          # otherwise its way too verbose
 
-        # Backward reaction
-        if len(back)>1:
-            bstructs, be = stretch(
-                xtb, output_folder + "/start.xyz",
-                atoms, back[0], back[-1], len(back),
-                parameters,
-                failout=output_folder + "/FAILED_BACKWARD",
-                verbose=False)          # otherwise its way too verbose
-
-            # note, we don't need the first step which is the same as the
-            # first step of forward
-            bstructs = bstructs[1:]
-            be = be[1:]
-        else:
-            bstructs = []
-            be = []
-
-        # Dump forward reaction and backward reaction quantities
-        dump_succ_opt(output_folder,
-                      bstructs[::-1] + fstructs,
-                      be[::-1] + fe,
-                      split=False)
-
-        # Now read results, optimize products and dump summary json
-        postprocess_reaction(xtb, output_folder,
-                             metadata={"mtdi":int(mtd_index)})
-
-    return react_job
+        # note, we don't need the first step which is the same as the
+        # first step of forward
+        bstructs = bstructs[1:]
+        be = be[1:]
+    else:
+        bstructs = []
+        be = []
+
+    # Dump forward reaction and backward reaction quantities
+    structures = bstructs[::-1] + fstructs
+    energies = be[::-1] + fe
+    dump_succ_opt(output_folder,
+                  structures,
+                  energies,
+                  split=False)
+
+    # Now analyze results, optimize products and dump summary json
+    postprocess_reaction(xtb, output_folder,
+                         metadata={"mtdi":int(mtd_index)},
+                         structures=structures, energies=energies)
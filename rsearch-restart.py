@@ -1,6 +1,6 @@
 import os
 import argparse
-from rsearch import rsearch
+from rsearch import rsearch, SafeLoader
 import yaml
 import shutil
 
@@ -22,6 +22,10 @@ if __name__ == "__main__":
     parser.add_argument("-w",
                         help="Overwrite output directory. Defaults to false.",
                         action="store_true")
+    parser.add_argument("--resume",
+                        help="Resume an interrupted search in the output directory,"
+                        +" skipping the steps it already completed. Defaults to false.",
+                        action="store_true")
     parser.add_argument("-t", "--threads",
                         help="Number of threads to use.",
                         type=int, default=1)
@@ -33,19 +37,17 @@ if __name__ == "__main__":
 
     args = parser.parse_args()
 
-    # Load user parameters (or try at least)
+    # Load user parameters (or try at least), keeping the file content around
+    # to copy it to the output directory.
     try:
         pfile = args.user_params
         with open(pfile, "r") as f:
-            user_params = yaml.load(f, Loader=yaml.Loader)
+            upfile = f.read()
     except IsADirectoryError:
         pfile = args.user_params + "/user.yaml"
         with open(pfile, "r") as f:
-            user_params = yaml.load(f, Loader=yaml.Loader)
-
-    # save user parameters
-    with open(pfile, "r") as f:
-        upfile = f.read()
+            upfile = f.read()
+    user_params = yaml.load(upfile, Loader=SafeLoader)
 
     # Prepare output files
     # --------------------
@@ -59,7 +61,10 @@ if __name__ == "__main__":
         os.makedirs(out_dir)
     except FileExistsError:
         print("Output directory exists:")
-        if args.w:
+        if args.resume:
+            print("   👍 but that's fine! --resume flag is on.")
+            print("   📁 %s is resumed." % out_dir)
+        elif args.w:
             # Delete the directory, make it and restart
             print("   👍 but that's fine! -w flag is on.")
             print("   📁 %s is overwritten." % out_dir)
@@ -84,8 +89,9 @@ if __name__ == "__main__":
             + "/parameters/default.yaml"
 
     with open(params_file, "r") as f:
-        default_params = yaml.load(f, Loader=yaml.Loader)
+        default_params = yaml.load(f, Loader=SafeLoader)
 
-    out = rsearch(out_dir, params_file,
+    out = rsearch(out_dir, default_params,
                   log_level=args.log_level,
-                  nthreads=args.threads)
+                  nthreads=args.threads,
+                  resume=args.resume)
@@ -1,17 +1,26 @@
 import numpy as np
 import react
+import react_utils
 from react_utils import stretch
 from analysis import postprocess_reaction
 import xtb_utils
 import io_utils
-from io_utils import pybel
+import rsearch_state
 import os
+import random
 import shutil
 import argparse
 from constants import hartree_ev, ev_kcalmol, bohr_ang
 import yaml
 from datetime import datetime
 
+# The C loader is much faster than the pure python one, but is only available
+# if pyyaml was built against libyaml.
+try:
+    from yaml import CSafeLoader as SafeLoader
+except ImportError:
+    from yaml import SafeLoader
+
 def cval(mol, atoms_i):
     atoms = [mol.GetAtom(i) for i in atoms_i]
     if len(atoms)==2:
@@ -21,7 +30,7 @@ def cval(mol, atoms_i):
     if len(atoms)==4:
         return mol.GetTorsion(*atoms)
 
-def init_xtb_driver(params, log_level=0):
+def init_xtb_driver(params, log_level=0, logfile=None):
     # todo : move this stuff to xtb_driver
     if "LOCALSCRATCH" in os.environ:
         scratch = os.environ["LOCALSCRATCH"]
@@ -35,15 +44,6 @@ def init_xtb_driver(params, log_level=0):
     else:
         delete=True
 
-    # Command log file
-    if log_level >0:
-        logfile = None          # TODO fix?
-        # logfile = open(out_dir + "/commandlog", "a")
-        # logfile.write("--------------------------"
-        #               +"--------------------------------------\n")
-    else:
-        logfile = None
-
     # Initialize the xtb driver
     # -------------------------
     xtb = xtb_utils.xtb_driver(scratch=scratch,
@@ -62,26 +62,80 @@ def init_xtb_driver(params, log_level=0):
     return xtb
 
 def rsearch(out_dir, defaults,
-            log_level=0, nthreads=1):
+            log_level=0, nthreads=1, resume=False):
 
     time_start = datetime.today().ctime()
 
+    # Completed steps are journaled so that an interrupted search can be
+    # resumed.
+    state = rsearch_state.state_store(out_dir + "/state.jsonl", resume=resume)
+
 
-    # load parameters
+    # load parameters. defaults is either the path to the default parameter
+    # file or its already loaded content.
     with open(out_dir + "/user.yaml", "r") as f:
-        user_params = yaml.load(f, Loader=yaml.Loader)
-    with open(defaults, "r") as f:
-        params = yaml.load(f, Loader=yaml.Loader)
+        user_params = yaml.load(f, Loader=SafeLoader)
+    if isinstance(defaults, dict):
+        params = dict(defaults)
+    else:
+        with open(defaults, "r") as f:
+            params = yaml.load(f, Loader=SafeLoader)
 
     # Merge, replacing defaults with user parameters
     for key,val in user_params.items():
         params[key] = val
 
-    xtb = init_xtb_driver(params, log_level=log_level)
+    # Fix the random seed, so that a resumed search shuffles structures the
+    # same way.
+    if params.get("seed") is None:
+        params["seed"] = state.get("seed", default=random.randrange(2**32))
+    state.mark("seed", value=params["seed"])
+
+    # Command log file
+    if log_level >0:
+        logfile = open(out_dir + "/commandlog", "a", buffering=1<<16)
+        logfile.write("--------------------------"
+                      +"--------------------------------------\n")
+    else:
+        logfile = None
+
+    try:
+        mtd_indices = rsearch_steps(out_dir, params, state, logfile,
+                                    log_level=log_level, nthreads=nthreads)
+    finally:
+        react_utils.drain_scratch_pool()
+        xtb_utils.remove_run_dirs()
+        state.close()
+        if logfile:
+            sync_log(logfile)
+            logfile.close()
+
+    time_end = datetime.today().ctime()
+    with open(out_dir + "/run.yaml", "w") as f:
+        # begin with some metadata
+        meta = io_utils.metadata()
+        meta["start"] = time_start
+        meta["end"] =time_end
+        yaml.dump(meta,f)
+        # Every parameter and then some
+        yaml.dump(params,f)
+        # dump extra stuff
+        yaml.dump({"nthreads":nthreads,
+                   "done_metadynamics_pts":[int(i) for i in mtd_indices]}, f)
 
-    # Temporarily set -P to number of threads for the next, non-parallelizable
+def sync_log(logfile):
+    """Write the buffered command log to disk."""
+    logfile.flush()
+    os.fsync(logfile.fileno())
+
+def rsearch_steps(out_dir, params, state, logfile,
+                  log_level=0, nthreads=1):
+    """Run the steps of rsearch() and return the metadynamics indices."""
+    xtb = init_xtb_driver(params, log_level=log_level, logfile=logfile)
+
+    # Temporarily use all threads in xtb for the next, non-parallelizable
     # two steps.
-    xtb.extra_args += ["-P", str(nthreads)]
+    xtb.nthreads = nthreads
 
     # Optimize starting geometry including wall
     # -----------------------------------------
@@ -93,30 +147,35 @@ def rsearch(out_dir, defaults,
     if not params["wall"]:
         # Load the molecule and compute its radius for the wall size
         at, pos = io_utils.xyz2numpy(params["xyz"])
-        # Compute all interatomic distances
-        distances = []
-        for i in range(len(at)):
-            for j in range(i):
-                distances += [np.sqrt(np.sum((pos[i] - pos[j])**2))]
+        # Compute all interatomic distances at once
+        diff = pos[:, np.newaxis, :] - pos[np.newaxis, :, :]
+        distances = np.sqrt(np.einsum("ijk,ijk->ij", diff, diff))
 
         # Cavity is 1.5 x maximum distance in diameter
-        radius_bohr = 0.5 * max(distances) * params["cavity_scale"] \
+        radius_bohr = 0.5 * distances.max() * params["cavity_scale"] \
             + 0.5 * params["cavity_offset"]
         radius_bohr /= bohr_ang
 
         print("Diameter of constraining cavity: %f A" % (2 * radius_bohr * bohr_ang))
         params["wall"] = ["potential=logfermi", "sphere:%f, all" % radius_bohr]
 
-    print("Optimizing initial geometry...")
-    opt = xtb.optimize(init0, init1,
-                       level=params["optim"],
-                       xcontrol={"wall":params["wall"],
-                                 # move to center of mass
-                                 "cma":""})
-    opt()
-
-    # Read result of optimization and set the maximum energy.
+    if state.done("opt"):
+        print("Initial geometry already optimized.")
+    else:
+        print("Optimizing initial geometry...")
+        opt = xtb.optimize(init0, init1,
+                           level=params["optim"],
+                           xcontrol={"wall":params["wall"],
+                                     # move to center of mass
+                                     "cma":""})
+        opt()
+        state.mark("opt")
+
+    # Read result of optimization and set the maximum energy. The energy is
+    # journaled, so that a resumed search keeps the same reference energy.
     mol, E = io_utils.traj2mols(init1, index=0)
+    E = state.get("E0", default=E)
+    state.mark("E0", value=E)
     print("    E₀    = %15.7f Eₕ" % E)
     params["E0"] = E
     Emax = E + params["emax_global"] / (hartree_ev * ev_kcalmol)
@@ -177,6 +236,9 @@ def rsearch(out_dir, defaults,
 
     # Constraints for the search
     # -------------------------
+    if not params['force']:
+        params['force'] = state.get("force")
+
     if not params['force']:
         # we do so quite simply from a 4 points polynomial fit
         params['force'] = 5.0
@@ -189,9 +251,12 @@ def rsearch(out_dir, defaults,
                 params,
                 verbose=True)
 
-            mols = [pybel.readstring("xyz", s.lower()).OBMol for s in structs]
-            x = [abs(cval(mol, atoms)) for mol in mols]
-            x = np.array(x)
+            # bond lengths of the scanned structures
+            x = np.empty(len(structs))
+            for i, s in enumerate(structs):
+                _, pos = io_utils.xyz2numpy(s)
+                d = pos[atoms[0]-1] - pos[atoms[1]-1]
+                x[i] = np.sqrt(d @ d)
 
             y = np.array(y)
             p = np.polyfit(x, y, 2)
@@ -203,67 +268,71 @@ def rsearch(out_dir, defaults,
             print("         force constant 💪💪 %f" % params["force"])
     else:
         print("    with force constant 💪💪 %f" % params["force"])
+    state.mark("force", value=params["force"])
 
 
     # STEP 1: Initial generation of guess conformers
     # ----------------------------------------------------------------------------
-    react.generate_initial_structures(
-        xtb, out_dir, init1,
-        atoms, low, high, npts,
-        params)
-
-    # reset threading
-    xtb.extra_args = xtb.extra_args[:-2]
-
-    # Refinement and selection
-    mtd_indices = react.select_initial_structures(
-        xtb, out_dir, init1,
-        atoms, low, high, npts,
-        params, nthreads=nthreads)
-
-    # STEP 2: Metadynamics
-    # ----------------------------------------------------------------------------
-    react.metadynamics_search(
-        xtb, out_dir,
-        mtd_indices,
-        atoms, low, high, npts,
-        params,
-        nthreads=nthreads)
-
-    react.metadynamics_refine(
-        xtb, out_dir,
-        init1,
-        mtd_indices,
-        atoms, low, high, npts,
-        params,
-        nthreads=nthreads)
-
-    # STEP 3: Reactions
-    # ----------------------------------------------------------------------------
-    react.react(
-        xtb, out_dir,
-        mtd_indices,
-        atoms, low, high, npts,
-        params,
-        nthreads=nthreads)
-
-    # todo: re-integrate
-    # if logfile:
-    #     logfile.close()
-
-
-    time_end = datetime.today().ctime()
-    with open(out_dir + "/run.yaml", "w") as f:
-        # begin with some metadata
-        meta = io_utils.metadata()
-        meta["start"] = time_start
-        meta["end"] =time_end
-        yaml.dump(io_utils.metadata(),f)
-        # Every parameter and then some
-        yaml.dump(params,f)
-        # dump extra stuff
-        yaml.dump({"nthreads":nthreads,
-                   "done_metadynamics_pts":list(mtd_indices)})
+    if not state.done("init"):
+        react.generate_initial_structures(
+            xtb, out_dir, init1,
+            atoms, low, high, npts,
+            params)
+        state.mark("init")
+
+    # reset threading: from now on, each worker runs single-threaded xtb jobs
+    xtb.nthreads = 1
+
+    # The workers append to the command log themselves.
+    if logfile:
+        sync_log(logfile)
+
+    # The remaining steps are run in parallel on a single pool of worker
+    # processes, shared between all of them.
+    with react.worker_pool(nthreads=nthreads) as pool:
+        # Refinement and selection
+        if state.done("select"):
+            mtd_indices = state.get("select")
+        else:
+            mtd_indices = react.select_initial_structures(
+                xtb, out_dir, init1,
+                atoms, low, high, npts,
+                params, nthreads=nthreads, pool=pool)
+            state.mark("select", value=[int(i) for i in mtd_indices])
+
+        # STEP 2: Metadynamics
+        # ------------------------------------------------------------------------
+        react.metadynamics_search(
+            xtb, out_dir,
+            mtd_indices,
+            atoms, low, high, npts,
+            params,
+            nthreads=nthreads,
+            pool=pool,
+            state=state)
+
+        react.metadynamics_refine(
+            xtb, out_dir,
+            init1,
+            mtd_indices,
+            atoms, low, high, npts,
+            params,
+            nthreads=nthreads,
+            pool=pool,
+            state=state)
+
+        # STEP 3: Reactions
+        # ------------------------------------------------------------------------
+        react.react(
+            xtb, out_dir,
+            mtd_indices,
+            atoms, low, high, npts,
+            params,
+            nthreads=nthreads,
+            pool=pool,
+            state=state)
+
+    return mtd_indices
 
 
 
@@ -364,7 +433,7 @@ if __name__ == "__main__":
             + "/parameters/default.yaml"
 
     with open(params_file, "r") as f:
-        default_params = yaml.load(f, Loader=yaml.Loader)
+        default_params = yaml.load(f, Loader=SafeLoader)
 
     # Save user-set command line parameters for reproducibility.
     user_params = {}
@@ -405,6 +474,6 @@ if __name__ == "__main__":
         f.write("\n")
 
     if not args.dump:
-        rsearch(out_dir, params_file,
+        rsearch(out_dir, default_params,
                 log_level=args.log_level,
                 nthreads=args.threads)
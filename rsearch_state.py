@@ -0,0 +1,73 @@
+# Checkpointing of reaction searches
+import json
+import numbers
+import os
+
+def _key(key):
+    # numpy integers (from np.arange etc.) are not json serializable
+    if isinstance(key, numbers.Integral):
+        return int(key)
+    return key
+
+class state_store:
+    def __init__(self, filename, resume=False):
+        """Journal of the completed steps of a reaction search.
+
+        Steps are identified by a phase name ("opt", "mtd", "react", etc.) and
+        an optional key, such as the index of a metadynamics job. Each step is
+        appended to the journal file as a line of json as soon as it is
+        marked, so that the journal survives crashes and a restarted search
+        only redoes the steps that are missing.
+
+        Parameters:
+        -----------
+
+        filename (str) : path to the journal file.
+
+        Optional Parameters:
+        --------------------
+
+        resume (bool) : if True, load the steps already recorded in filename.
+        Otherwise, the journal is started over. Defaults to False.
+
+        """
+        self.filename = filename
+        self.phases = {}
+        if resume and os.path.exists(filename):
+            good = 0
+            with open(filename, "r") as f:
+                lines = f.readlines()
+            for line in lines:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # last line was only partially written
+                    break
+                self.phases.setdefault(
+                    entry["phase"], {})[_key(entry["key"])] = entry["value"]
+                good += len(line)
+            self.file = open(filename, "r+")
+            # drop the partial line, if any
+            self.file.seek(good)
+            self.file.truncate()
+        else:
+            self.file = open(filename, "w")
+
+    def done(self, phase, key=None):
+        """Return True if step (phase, key) was completed."""
+        return _key(key) in self.phases.get(phase, {})
+
+    def get(self, phase, key=None, default=None):
+        """Return the value recorded for step (phase, key)."""
+        return self.phases.get(phase, {}).get(_key(key), default)
+
+    def mark(self, phase, key=None, value=True):
+        """Record step (phase, key) as completed, with a json-able value."""
+        key = _key(key)
+        self.phases.setdefault(phase, {})[key] = value
+        self.file.write(json.dumps({"phase":phase, "key":key, "value":value})
+                        + "\n")
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
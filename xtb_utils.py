@@ -38,6 +38,55 @@ def make_xcontrol(xcontrol_dictionary, fn):
         f.write("$end\n")
     return fn
 
+# Directories reused by successive runs, one per process and scratch
+# directory, to avoid creating and deleting a directory for every run.
+_run_dirs = {}
+# Run directories claimed by a job that has not been closed yet.
+_busy_run_dirs = set()
+
+def get_run_dir(scratch):
+    """Return the run directory of the current process in scratch."""
+    key = (os.getpid(), scratch)
+    if key not in _run_dirs:
+        _run_dirs[key] = tempfile.mkdtemp(dir=scratch,
+                                          prefix="worker-%i-" % os.getpid())
+    return _run_dirs[key]
+
+def remove_run_dirs():
+    """Delete the run directories of the current process."""
+    pid = os.getpid()
+    for key in list(_run_dirs):
+        if key[0] == pid:
+            shutil.rmtree(_run_dirs.pop(key), ignore_errors=True)
+
+# Command log handles of worker processes, one per process and log file.
+_log_files = {}
+
+def get_log_file(filename):
+    """Return the command log handle of the current process for filename."""
+    key = (os.getpid(), filename)
+    if key not in _log_files:
+        # line buffered, so that the commands of concurrent workers are not
+        # interleaved
+        _log_files[key] = open(filename, "a", buffering=1)
+    return _log_files[key]
+
+def close_log_files():
+    """Close the command log handles of the current process."""
+    pid = os.getpid()
+    for key in list(_log_files):
+        if key[0] == pid:
+            _log_files.pop(key).close()
+
+def clear_dir(path):
+    """Delete the content of directory path."""
+    with os.scandir(path) as it:
+        for entry in it:
+            if entry.is_dir(follow_symlinks=False):
+                shutil.rmtree(entry.path)
+            else:
+                os.remove(entry.path)
+
 
 class xtb_run:
     def __init__(self, xtb, geom_file, *args,
@@ -47,9 +96,13 @@ class xtb_run:
                  logfile=None,
                  other_input_files=[],
                  xcontrol={},
+                 xcontrol_file=None,
                  restart=None,
                  failout=None,
                  delete=True,
+                 input_str=None,
+                 nthreads=1,
+                 rundir=None,
                  return_files=[]):
         """Build a container for an xtb run.
 
@@ -74,21 +127,50 @@ class xtb_run:
         xcontrol (dict) : dictionary of xcontrol options, interpreted using
         make_xcontrol.
 
+        xcontrol_file (str) : Path to an existing xcontrol file, used instead
+        of xcontrol. Allows a single file to be shared by many runs.
+
         failout (str) : Path where xtb.out is output if the run fails.
 
         delete (bool) : If true, delete all temporary files after run.
         Defaults to true
 
+        input_str (str) : If set, the geometry is written from this string
+        directly to the run directory, under the base name of geom_file,
+        instead of being copied from geom_file.
+
+        nthreads (int) : Number of OpenMP/MKL threads the run may use. Set
+        explicitly in the environment of the process, so that concurrent runs
+        do not each grab every core. Defaults to 1. OMP_STACKSIZE is also set
+        to 4G, unless already set.
+
+        rundir (str) : If set, the run happens in this existing directory
+        instead of a new temporary one. The directory is emptied when the job
+        is prepared, and not deleted afterwards. It is held by the job until
+        close() is called; if another job holds it, a new temporary
+        directory is used instead.
+
         return_files (list) : list of tuples of filenames (filein, fileout) of
         files to be copied out of the temporary run directory automatically
         when close() is called. For example, [("xtbopt.xyz", "my_opt.xyz")]
         will generate the file my_opt.xyz from the xtb optimized geometry
-        xtbopt.xyz in the run directory.
+        xtbopt.xyz in the run directory. If fileout is None, the content of
+        filein is instead read into self.output[filein].
 
         TODO UPDATE PARAMETERS
         """
         self.logfile = logfile
-        self.dir = tempfile.mkdtemp(dir=scratch, prefix="tmp"+prefix)
+        if rundir in _busy_run_dirs:
+            # a job prepared earlier has not been closed yet
+            rundir = None
+        if rundir is None:
+            self.dir = tempfile.mkdtemp(dir=scratch, prefix="tmp"+prefix)
+        else:
+            # leftover files, such as xtbrestart, would be read by xtb
+            clear_dir(rundir)
+            _busy_run_dirs.add(rundir)
+            self.dir = rundir
+        self.rundir = rundir
         self.delete = delete
         if self.delete:
             # The xtb output can be extremely large so if we are going to
@@ -99,7 +181,12 @@ class xtb_run:
             self.out = open(self.dir + "/xtb.out", "w")
 
         self.err = open(self.dir + "/xtb.err", "w")
-        self.coord = shutil.copy(geom_file, self.dir)
+        if input_str is None:
+            self.coord = shutil.copy(geom_file, self.dir)
+        else:
+            self.coord = self.dir + "/" + os.path.basename(geom_file)
+            with open(self.coord, "w") as f:
+                f.write(input_str)
         for fn in other_input_files:
             shutil.copy(fn, self.dir)
 
@@ -109,9 +196,13 @@ class xtb_run:
 
         self.return_files = return_files   # list of files to take out when
                                            # run finishes
+        self.output = {}
 
         self.args = [xtb]
-        if xcontrol:
+        if xcontrol_file:
+            self.xcontrol = os.path.abspath(xcontrol_file)
+            self.args += ["-I", self.xcontrol]
+        elif xcontrol:
             self.xcontrol = make_xcontrol(xcontrol, self.dir + "/.xcontrol")
             self.args += ["-I", os.path.basename(self.xcontrol)]
         else:
@@ -120,9 +211,16 @@ class xtb_run:
         self.args += args
         self.args += [before_geometry, os.path.basename(self.coord)]
 
+        env = dict(os.environ)
+        env["OMP_NUM_THREADS"] = str(nthreads)
+        env["MKL_NUM_THREADS"] = str(nthreads)
+        # xtb needs a large OpenMP stack for larger systems
+        env.setdefault("OMP_STACKSIZE", "4G")
+
         self.kwargs = dict(stderr=self.err,
                            stdout=self.out,
-                           cwd=self.dir)
+                           cwd=self.dir,
+                           env=env)
 
         self.proc = None
 
@@ -131,7 +229,6 @@ class xtb_run:
         assert self.proc is None
         if self.logfile:
             self.logfile.write(self.get_cmdline())
-            self.logfile.flush()
         self.proc = subprocess.Popen(self.args, **self.kwargs)
         if blocking:
             self.proc.wait()
@@ -186,7 +283,11 @@ class xtb_run:
         # Get output file to pass to caller
         try:
             for file_in, file_out in self.return_files:
-                self.cp(file_in,file_out)
+                if file_out is None:
+                    with open(self.dir + "/" + file_in, "r") as f:
+                        self.output[file_in] = f.read()
+                else:
+                    self.cp(file_in,file_out)
             IOERROR = False
         except FileNotFoundError:
             IOERROR = True
@@ -197,8 +298,9 @@ class xtb_run:
                 self.tempd_dump(self.failout)
 
         # Finally delete the temporary directory if needed.
-        if self.delete:
+        if self.delete and self.rundir is None:
             shutil.rmtree(self.dir)
+        _busy_run_dirs.discard(self.rundir)
 
         if IOERROR:
             return -1
@@ -231,7 +333,8 @@ class xtb_run:
 class xtb_driver:
     def __init__(self, path_to_xtb_binaries="",
                  delete=True, logfile=None,
-                 xtb_args=[], scratch="."):
+                 xtb_args=[], scratch=".",
+                 persistent=True):
         """Utility driver for xtb runs.
 
         Methods include various kind of xtb runs.
@@ -249,13 +352,47 @@ class xtb_driver:
 
         scratch (str) : scratch directory for xtb runs, defaults to ".".
 
+        persistent (bool) : if true, each process runs xtb in a single
+        directory of scratch, reused by all its runs. Only applies when delete
+        is true. Defaults to true.
+
+        The number of threads of each run is set by the nthreads attribute,
+        which defaults to 1.
+
         """
         self.extra_args = xtb_args
+        self.nthreads = 1
         self.xtb_bin = path_to_xtb_binaries + "xtb"
         self.crest_bin = path_to_xtb_binaries + "crest"
         self.scratchdir = scratch
         self.logfile = logfile
         self.delete=delete
+        self.persistent = persistent
+
+    def __getstate__(self):
+        # Open files can't be sent to worker processes, which append to the
+        # command log on their own instead.
+        state = self.__dict__.copy()
+        if self.logfile:
+            state["logfile"] = self.logfile.name
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if self.logfile:
+            self.logfile = get_log_file(self.logfile)
+
+    def __copy__(self):
+        # copies in the same process share the log file
+        new = self.__class__.__new__(self.__class__)
+        new.__dict__.update(self.__dict__)
+        return new
+
+    def run_dir(self):
+        """Return the directory to use for the next run, or None."""
+        if self.persistent and self.delete:
+            return get_run_dir(self.scratchdir)
+        return None
 
     def optimize(self,
                  geom_file,
@@ -265,15 +402,20 @@ class xtb_driver:
                  compute_hessian=False,
                  log=None,
                  failout=None,
-                 restart=None):
+                 restart=None,
+                 input_str=None,
+                 xcontrol_file=None):
         """Optimize a molecule.
 
         Parameters:
         -----------
 
         geom_file (str) : path to the file containing the molecular geometry.
+        Can be None if input_str is given.
 
-        out_file (str): path to file where optimized geometry is saved.
+        out_file (str): path to file where optimized geometry is saved. If
+        None, the optimized geometry (or the scan trajectory) is kept in memory
+        instead, in the output dictionary of the returned job.
 
         Optional Parameters:
         --------------------
@@ -295,12 +437,20 @@ class xtb_driver:
         restart (str) : Setup a xtbrestart file that will be read for the run
         and written with restart details when the run is over.
 
+        input_str (str) : Molecular geometry as an xyz string. It is written
+        directly to the run directory, skipping the geometry file.
+
+        xcontrol_file (str) : Path to an xcontrol file already rendered from
+        xcontrol by make_xcontrol, used in place of a new one.
+
         Returns:
         --------
 
         xtb_run : The optimization job. Run using xtb_run().
 
         """
+        if geom_file is None:
+            geom_file = "input.xyz"
 
         file_ext = geom_file[-3:]
         if "scan" in xcontrol:
@@ -326,13 +476,18 @@ class xtb_driver:
         opt = xtb_run(self.xtb_bin, geom_file,
                       oflag, level,
                       *self.extra_args,
+                      "-P", str(self.nthreads),
                       xcontrol=xcontrol,
+                      xcontrol_file=xcontrol_file,
                       restart=restart,
                       prefix="OPT",
                       scratch=self.scratchdir,
                       delete=self.delete,
                       failout=failout,
                       logfile=self.logfile,
+                      input_str=input_str,
+                      nthreads=self.nthreads,
+                      rundir=self.run_dir(),
                       return_files=return_files)
         return opt
 
@@ -370,12 +525,15 @@ class xtb_driver:
         md = xtb_run(self.xtb_bin, geom_file,
                      "--metadyn",
                      *self.extra_args,
+                     "-P", str(self.nthreads),
                      xcontrol=xcontrol,
                      prefix="MTD",
                      delete=self.delete,
                      scratch=self.scratchdir,
                      failout=failout,
                      logfile=self.logfile,
+                     nthreads=self.nthreads,
+                     rundir=self.run_dir(),
                      return_files=return_files)
         return md
 
@@ -392,7 +550,9 @@ class xtb_driver:
 
         ensemble_file (str) : path to the file containing the ensemble.
 
-        out_file (str): path to file where results are saved.
+        out_file (str): path to file where results are saved. If None, the
+        results are kept in memory, in the output dictionary of the returned
+        job.
 
         Optional Parameters:
         --------------------
@@ -418,5 +578,7 @@ class xtb_driver:
                       delete=self.delete,
                       scratch=self.scratchdir,
                       logfile=self.logfile,
+                      nthreads=self.nthreads,
+                      rundir=self.run_dir(),
                       return_files=return_files)
         return cre